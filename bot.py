@@ -3,7 +3,17 @@
 import os
 import re
 import json
+try:
+    import orjson  # быстрый C-парсер JSON, опционально
+except ImportError:
+    orjson = None
+# JSON из LLM и recurrence_json: orjson, если стоит; иначе stdlib (тот же UTF-8 без \u-экранирования)
+json_loads = orjson.loads if orjson else json.loads
+def json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj, ensure_ascii=False)
 import socket
+import threading
+import time
 from urllib.parse import urlsplit, urlunsplit, parse_qsl
 
 import psycopg
@@ -20,7 +30,21 @@ import sys
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import asyncio
-import tempfile
+import io
+import importlib.util
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+try:
+    from itertools import batched  # 3.12+
+except ImportError:
+    def batched(iterable, n):
+        it = iter(iterable)
+        while chunk := tuple(islice(it, n)):
+            yield chunk
+from typing import TypedDict
 
 from dateutil import parser as dparser
 
@@ -29,27 +53,52 @@ from telegram import (
     ReplyKeyboardMarkup, KeyboardButton
 )
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ContextTypes, PicklePersistence, filters
 )
 
 
 # ---------- Logging ----------
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "DEBUG").upper(),
     format="%(asctime)s %(levelname)s %(name)s: %(message)s",
     stream=sys.stdout,
 )
 log = logging.getLogger("planner-bot")
 
+def _drop_poll_timeouts(record: logging.LogRecord) -> bool:
+    """TimedOut long-poll getUpdates — штатная ситуация, не ошибка."""
+    return not (record.name.startswith("telegram") and "Timed out" in record.getMessage())
+
+for _h in logging.getLogger().handlers:
+    _h.addFilter(_drop_poll_timeouts)
+# httpx пишет каждый getUpdates на INFO (с токеном в URL)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # ---------- ENV ----------
-BOT_TOKEN = os.environ.get("BOT_TOKEN") or os.environ.get("TELEGRAM_TOKEN")
+# токены часто копируют из чатов/доков вместе с zero-width и BOM — срезаем одним проходом
+_ZW_TRANS = str.maketrans("", "", "\u200b\u200c\u200d\u2060\ufeff")
+
+def _env_token(*names: str) -> str | None:
+    for name in names:
+        v = (os.environ.get(name) or "").translate(_ZW_TRANS).strip()
+        if v: return v
+    return None
+
+BOT_TOKEN = _env_token("BOT_TOKEN", "TELEGRAM_TOKEN")
+STATE_PATH = os.environ.get("STATE_PATH", "bot_state.pkl")
+WEBHOOK_URL = (os.environ.get("WEBHOOK_URL") or "").rstrip("/")  # публичный https-адрес; пусто — polling
+PORT = int(os.environ.get("PORT", "8443"))
 PROMPTS_PATH = os.environ.get("PROMPTS_PATH", "prompts.yaml")
 DB_PATH = os.environ.get("DB_PATH", "reminders.db")
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-
-# --- LLM context injection state ---
-_CTX_INJECTION = {}
+OPENAI_API_KEY = _env_token("OPENAI_API_KEY")
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "4"))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "400"))  # ответ — короткий JSON
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "30"))  # у SDK по умолчанию 600 с
+HTTP2 = importlib.util.find_spec("h2") is not None
+# распознавание голоса: "openai" (whisper-1 по API) или "local" (faster-whisper, int8 на CPU)
+ASR_BACKEND = (os.environ.get("ASR_BACKEND") or "openai").strip().lower()
+ASR_MODEL = os.environ.get("ASR_MODEL", "small")
 
 DATABASE_URL = (os.environ.get("DATABASE_URL") or "").strip()
 DB_DIALECT = ((os.environ.get("DB_DIALECT") or ("postgres" if DATABASE_URL else "sqlite")).strip().lower())
@@ -62,6 +111,10 @@ if missing:
     log.error("Missing required environment/files: %s", ", ".join(missing))
     sys.exit(1)
 
+if ASR_BACKEND == "local" and importlib.util.find_spec("faster_whisper") is None:
+    log.warning("ASR_BACKEND=local, но faster-whisper не установлен — голос пойдёт в OpenAI.")
+    ASR_BACKEND = "openai"
+
 if not OPENAI_API_KEY:
     log.warning("OPENAI_API_KEY не задан — LLM-парсер недоступен, но быстрый парсер покроет типовые кейсы.")
 
@@ -121,6 +174,23 @@ def _url_with_ipv4_host(url: str) -> tuple[str, str | None, dict]:
     return new_url, ipv4, parts
 
 # ---------- DB ----------
+_sqlite_local = threading.local()
+
+def _sqlite_conn():
+    """Одно sqlite-соединение на поток (loop + воркеры to_thread): без open/pragma
+    на каждый запрос; `with conn:` только коммитит, не закрывает."""
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None:
+        import sqlite3
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        conn.row_factory = sqlite3.Row
+        # WAL (включён в db_init) + synchronous=NORMAL: без fsync на каждый commit
+        conn.execute("pragma synchronous=normal")
+        conn.execute("pragma temp_store=memory")
+        conn.execute("pragma mmap_size=134217728")   # 128 МБ
+        _sqlite_local.conn = conn
+    return conn
+
 def db():
     """
     Подключение к БД:
@@ -128,13 +198,10 @@ def db():
     - иначе sqlite.
     """
     if DB_DIALECT != "postgres":
-        import sqlite3
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return _sqlite_conn()
 
     conn_url_ipv4, ipv4, parts = _url_with_ipv4_host(DATABASE_URL)
-    log.info("Postgres connect try: url_ipv4=%s, ipv4=%s, host=%s",
+    log.debug("Postgres connect try: url_ipv4=%s, ipv4=%s, host=%s",
              "set" if conn_url_ipv4 != DATABASE_URL else "same",
              ipv4, parts.get("host"))
 
@@ -163,23 +230,79 @@ def db():
         "autocommit": True,
         "row_factory": dict_row,
     }
-    log.info("Postgres connect kwargs: %s", {k: kwargs[k] for k in ("hostaddr","host","port","dbname","sslmode")})
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Postgres connect kwargs: %s", {k: kwargs[k] for k in ("hostaddr","host","port","dbname","sslmode")})
     return psycopg.connect(**kwargs)
 
 # ---------- TZ / ISO ----------
+# форматы ввода, которые проверяются fullmatch'ем на каждом ответе
+_HHMM_RX = re.compile(r"(\d{1,2})(?::?(\d{2}))?")           # «10», «1030», «10:30»
+_HHMMSS_RX = re.compile(r"(\d{1,2}):(\d{2})(?::\d{2})?")
+_HH_MM_RX = re.compile(r"\d{2}:\d{2}")
+_DDMM_RX = re.compile(r"(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?")
+_PRE_RX = re.compile(r"pre:(\d+):(\d+)")
+_PRE2_TOGGLE_RX = re.compile(r"pre2:toggle:(\d+)")
+
+def _scan_offset(t: str) -> tuple[str, str, str | None] | None:
+    """«±H», «±HH», «±HMM», «±HHMM», «±H:MM», «±HH:MM» -> (знак, часы, минуты|None).
+    Ручной разбор: вызывается на каждый входящий текст (проверка «это TZ?»)."""
+    if len(t) < 2 or t[0] not in "+-":
+        return None
+    rest = t[1:]
+    if ":" in rest:
+        hh, _, mm = rest.partition(":")
+        if len(mm) != 2 or not mm.isdecimal(): return None
+    elif len(rest) > 2:
+        hh, mm = rest[:-2], rest[-2:]
+    else:
+        hh, mm = rest, None
+    if not (1 <= len(hh) <= 2 and hh.isdecimal()) or (mm is not None and not mm.isdecimal()):
+        return None
+    return t[0], hh, mm
+
+@lru_cache(maxsize=64)
 def tzinfo_from_user(tz_str: str) -> timezone | ZoneInfo:
     tz_str = (tz_str or "+03:00").strip()
     if tz_str[0] in "+-":
-        m = re.fullmatch(r"([+-])(\d{1,2})(?::?(\d{2}))?$", tz_str)
-        if not m: raise ValueError("invalid offset")
-        sign, hh, mm = m.group(1), int(m.group(2)), int(m.group(3) or 0)
-        delta = timedelta(hours=hh, minutes=mm)
+        # основной формат «+HH:MM» (так пишет normalize_offset) — срезами, без regex
+        if len(tz_str) == 6 and tz_str[3] == ":" and tz_str[1:3].isdigit() and tz_str[4:].isdigit():
+            delta = timedelta(hours=int(tz_str[1:3]), minutes=int(tz_str[4:]))
+            return timezone(-delta if tz_str[0] == "-" else delta)
+        parts = _scan_offset(tz_str)
+        if not parts: raise ValueError("invalid offset")
+        sign, hh, mm = parts
+        delta = timedelta(hours=int(hh), minutes=int(mm or 0))
         if sign == "-": delta = -delta
         return timezone(delta)
     return ZoneInfo(tz_str)
 
+# «сейчас» в UTC, обновляется не чаще раза в 50 мс: для сравнений
+# «уже прошло?» и NOW для LLM этого хватает, а handler'ы зовут часто
+_NOW_UTC_CACHE = [datetime.now(timezone.utc), 0.0]
+
+def _now_utc() -> datetime:
+    t = time.monotonic()
+    if t - _NOW_UTC_CACHE[1] > 0.05:
+        _NOW_UTC_CACHE[0] = datetime.now(timezone.utc); _NOW_UTC_CACHE[1] = t
+    return _NOW_UTC_CACHE[0]
+
 def now_in_user_tz(tz_str: str) -> datetime:
-    return datetime.now(tzinfo_from_user(tz_str))
+    return _now_utc().astimezone(tzinfo_from_user(tz_str))
+
+@lru_cache(maxsize=64)
+def _iso_at(tz_str: str, epoch_sec: int) -> str:
+    return datetime.fromtimestamp(epoch_sec, tzinfo_from_user(tz_str)).isoformat()
+
+def now_iso_for_tz(tz_str: str) -> str:
+    """NOW для LLM с точностью до секунды: в пределах секунды — готовая строка."""
+    return _iso_at(tz_str, int(time.time()))
+
+def parse_iso(s: str) -> datetime:
+    """fromisoformat (C, понимает «Z» с 3.11), dateutil — только для экзотики."""
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        return dparser.isoparse(s)
 
 def iso_utc(dt: datetime) -> str:
     if dt.tzinfo is None: raise ValueError("aware dt required")
@@ -187,7 +310,16 @@ def iso_utc(dt: datetime) -> str:
     return dt.isoformat()
 
 def to_user_local(utc_iso: str, user_tz: str) -> datetime:
-    return dparser.isoparse(utc_iso).astimezone(tzinfo_from_user(user_tz))
+    return parse_iso(utc_iso).astimezone(tzinfo_from_user(user_tz))
+
+def fmt_local(dt: datetime) -> str:
+    """«dd.mm в HH:MM» без strftime."""
+    return f"{dt.day:02d}.{dt.month:02d} в {dt.hour:02d}:{dt.minute:02d}"
+
+@lru_cache(maxsize=256)
+def fmt_utc_iso(utc_iso: str, user_tz: str) -> str:
+    """fmt_local для when_iso из БД; одна строка уходит и в подтверждение, и в /list."""
+    return fmt_local(to_user_local(utc_iso, user_tz))
 
 # ---------- UI ----------
 MAIN_MENU_KB = ReplyKeyboardMarkup(
@@ -213,17 +345,46 @@ CITY_TO_OFFSET = {
     "Якутск (+9)": "+09:00",
     "Хабаровск (+10)": "+10:00",
 }
-def build_tz_inline_kb() -> InlineKeyboardMarkup:
-    rows = []
-    for row in _TZ_ROWS:
-        btns = []
-        for label in row:
-            if label == "Другой…":
-                btns.append(InlineKeyboardButton(label, callback_data="tz:other"))
-            else:
-                off = CITY_TO_OFFSET[label]
-                btns.append(InlineKeyboardButton(label, callback_data=f"tz:{off}"))
-        rows.append(btns)
+# клавиатура выбора TZ — чистая функция констант выше, собираем один раз при импорте
+TZ_INLINE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(label, callback_data="tz:other" if label == "Другой…" else f"tz:{CITY_TO_OFFSET[label]}")
+     for label in row]
+    for row in _TZ_ROWS
+])
+
+WEEKDAY_ANSWER_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("пн", callback_data="answer:пн")],
+    [InlineKeyboardButton("вт", callback_data="answer:вт")],
+    [InlineKeyboardButton("ср", callback_data="answer:ср")],
+    [InlineKeyboardButton("чт", callback_data="answer:чт")],
+    [InlineKeyboardButton("пт", callback_data="answer:пт")],
+    [InlineKeyboardButton("сб", callback_data="answer:сб")],
+    [InlineKeyboardButton("вс", callback_data="answer:вс")],
+])
+
+def _time_variant_label(t: str) -> str:
+    hh = int(t[:2])
+    if hh == 0: return "в 00:00"
+    if 1 <= hh <= 11: return f"в {hh} утра"
+    return f"в {hh} часов"
+
+def time_variants_kb(v1: str, v2: str) -> InlineKeyboardMarkup:
+    """Две кнопки «HH:MM» в один ряд (утро/вечер)."""
+    b1 = InlineKeyboardButton(_time_variant_label(v1), callback_data=f"answer:{v1}")
+    b2 = InlineKeyboardButton(_time_variant_label(v2), callback_data=f"answer:{v2}")
+    return InlineKeyboardMarkup([[b1, b2]])
+
+def cancel_kb(rem_id: int) -> InlineKeyboardMarkup:
+    """Кнопка «Отменить» под подтверждением."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
+
+def fire_kb(rem_id: int, kind: str = "oneoff") -> InlineKeyboardMarkup:
+    """Кнопки под сработавшим напоминанием; ✅ — только для одноразовых."""
+    rid = str(rem_id)
+    rows = [[InlineKeyboardButton("Через 10 мин", callback_data="snooze:10:" + rid),
+             InlineKeyboardButton("Через 1 час", callback_data="snooze:60:" + rid)]]
+    if kind == "oneoff":
+        rows.append([InlineKeyboardButton("✅", callback_data="done:" + rid)])
     return InlineKeyboardMarkup(rows)
 
 async def safe_reply(update: Update, text: str, reply_markup=None):
@@ -243,8 +404,8 @@ def normalize_offset(sign: str, hh: str, mm: str | None) -> str:
 def parse_tz_input(text: str) -> str | None:
     t = (text or "").strip()
     if t in CITY_TO_OFFSET: return CITY_TO_OFFSET[t]
-    m = re.fullmatch(r"([+-])(\d{1,2})(?::?(\d{2}))?$", t)
-    if m: return normalize_offset(m.group(1), m.group(2), m.group(3))
+    parts = _scan_offset(t)
+    if parts: return normalize_offset(*parts)
     if "/" in t and " " not in t:
         try: ZoneInfo(t); return t
         except Exception: return None
@@ -252,24 +413,179 @@ def parse_tz_input(text: str) -> str | None:
 
 # ---------- Prompts ----------
 import yaml
+try:
+    from yaml import CSafeLoader as _YamlLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+_PROMPTS_CACHE: tuple[float, dict] | None = None
+
 def load_prompts():
+    """Парсит prompts.yaml; при неизменном mtime отдаёт уже разобранное."""
+    global _PROMPTS_CACHE
+    mtime = os.stat(PROMPTS_PATH).st_mtime
+    if _PROMPTS_CACHE and _PROMPTS_CACHE[0] == mtime:
+        return _PROMPTS_CACHE[1]
     with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        data = yaml.load(f, Loader=_YamlLoader)
+    _PROMPTS_CACHE = (mtime, data)
+    return data
 PROMPTS = load_prompts()
+# статичный префикс сообщений для call_llm: system + parse + fewshot
+_BASE_MESSAGES = (
+    {"role": "system", "content": PROMPTS["system"]},
+    {"role": "system", "content": PROMPTS["parse"]["system"]},
+    *(PROMPTS.get("fewshot") or []),
+)
 
 # ---------- OpenAI ----------
-from openai import OpenAI
 _client = None
 def get_openai():
     global _client
     if _client is None:
-        _client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        # SDK (pydantic-модели, сотни модулей) грузим при первом запросе к модели, а не на старте:
+        # холодный старт быстрее, а без OPENAI_API_KEY он не загрузится вовсе
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        # async-клиент: ожидание ответа не держит ни loop, ни поток;
+        # HTTP/2 — если стоит h2. Апдейты обрабатываются по одному, в полёте — запрос-другой
+        # (LLM или whisper): пары тёплых keep-alive соединений хватает, без handshake на каждый вызов
+        _client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            # пользователь ждёт ответа в чате: зависший запрос обрываем и
+            # даём SDK повторить (с backoff, без блокировки loop)
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+            max_retries=2,
+            http_client=DefaultAsyncHttpxClient(
+                http2=HTTP2,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            ),
+        )
     return _client
 
-# --- LLM context injection (для CTX_* строк)
-_CTX_INJECTION = {}
+class LLMResult(TypedDict, total=False):
+    """Контракт ответа LLM — обычный dict, без валидации моделью."""
+    intent: str
+    title: str
+    fixed_datetime: str | None
+    when_local: str | None
+    recurrence: dict | None
+    expects: str | None
+    question: str
+    variants: list
+    base_date: str | None
+
+# ожидаемые типы вложенных полей: чужой тип выкидываем, а не падаем в handle_text на .get()
+_LLM_FIELD_TYPES = {"recurrence": dict, "variants": list}
+
+def _coerce_llm_result(data: dict) -> LLMResult:
+    for k, t in _LLM_FIELD_TYPES.items():
+        v = data.get(k)
+        if v is not None and not isinstance(v, t):
+            log.warning("LLM field %s has type %s, dropped", k, type(v).__name__)
+            data.pop(k)
+    return data
+
+# --- LLM cache: повтор фразы не гоняем в модель второй раз.
+# Значение — (ответ, сдвиг от NOW в секундах или None для абсолютной даты,
+# monotonic-срок годности по TTL). Абсолютная дата, которая уже наступила,
+# отбрасывается при чтении (_llm_cache_hit) — иначе напоминание ушло бы в прошлое.
+# Ключ (текст, TZ) — для ответов, не зависящих от NOW (см. _llm_cache_entry);
+# (текст, TZ, локальный час) — для остальных: «завтра в 10» верно до конца часа.
+_LLM_CACHE: "OrderedDict[tuple, tuple[LLMResult, float | None, float]]" = OrderedDict()
+_LLM_CACHE_MAX = int(os.environ.get("LLM_CACHE_SIZE", "512"))  # 0 — кэш выключен
+_LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(24 * 3600)))
+# полная дата: «05.05.2027» или «5 мая 2027». Голый «2015» — это время «в 20:15» (как «в 1140»), не год
+_ABS_DATE_RX = re.compile(
+    r"\b\d{1,2}\.\d{1,2}\.\d{4}\b"
+    r"|\b\d{1,2}\s+(?:январ|феврал|март|апрел|ма[йя]|июн|июл|август|сентябр|октябр|ноябр|декабр)\w*\s+\d{4}\b"
+)
+_REL_WORDS_RX = re.compile(r"через|спустя|сейчас|сегодня|завтра|вчера|кажд|недел|месяц")
+_REL_DELTA_RX = re.compile(r"через\s+(?:полчаса|минуту|час|\d+\s*(?:сек|мин|час)\w*)")
+
+def _llm_cache_key(user_text: str, user_tz: str) -> tuple[str, str]:
+    return _clean_spaces(user_text.lower()), user_tz or "+03:00"
+
+def _llm_cache_entry(norm_text: str, result: dict, now_local: datetime) -> tuple[dict, float | None] | None:
+    """Что положить в кэш: абсолютная дата — как есть, «через N …» — как сдвиг от NOW."""
+    if (result.get("intent") or "").lower() != "create_reminder" or not result.get("fixed_datetime"):
+        return None
+    if result.get("recurrence") or result.get("expects"):
+        return None
+    if _ABS_DATE_RX.search(norm_text) and not _REL_WORDS_RX.search(norm_text):
+        return dict(result), None
+    m = _REL_DELTA_RX.search(norm_text) if "через" in norm_text else None
+    if m:
+        rest = norm_text[:m.start()] + norm_text[m.end():]
+        if any(ch.isdigit() for ch in rest) or _REL_WORDS_RX.search(rest):
+            return None
+        try:
+            when = parse_iso(result["fixed_datetime"])
+        except Exception:
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=now_local.tzinfo)
+        return dict(result), (when - now_local).total_seconds()
+    return None
 
-async def call_llm(user_text: str, user_tz: str, now_iso_override: str | None = None) -> dict:
+# «через 2 часа 30 минут», «через пару часов», «сейчас» — отсчёт от NOW с точностью до минут:
+# такой ответ, взятый из часового кэша, сработает раньше (или уже в прошлом)
+_NOW_REL_RX = re.compile(r"через|спустя|сейчас|позже")
+
+def _llm_hour_cacheable(norm_text: str, result: dict) -> bool:
+    """Часовой кэш — только для ответов, привязанных к дню, а не к минуте NOW («завтра в 10», чат)."""
+    # уточнения зависят от диалога — их не кэшируем
+    if (result.get("intent") or "").lower() == "ask_clarification" or result.get("expects"):
+        return False
+    if _NOW_REL_RX.search(norm_text):
+        return False
+    # интервал от модели несёт start_at=NOW — повтор через час стартовал бы в прошлом
+    rec = result.get("recurrence")
+    return not (isinstance(rec, dict) and rec.get("start_at"))
+
+def _llm_hour_key(key: tuple[str, str], now_local: datetime) -> tuple[str, str, int]:
+    return (*key, now_local.toordinal() * 24 + now_local.hour)
+
+def _llm_cache_hit(key: tuple, now_local: datetime) -> LLMResult | None:
+    """Копия ответа из кэша с fixed_datetime на сейчас; уже наступившая дата — промах."""
+    entry = _llm_cache_get(key)
+    if entry is None:
+        return None
+    cached, delta, _ = entry
+    hit = dict(cached)
+    if delta is not None:
+        hit["fixed_datetime"] = (now_local + timedelta(seconds=delta)).replace(microsecond=0).isoformat()
+        return hit
+    fixed = hit.get("fixed_datetime")
+    if fixed:
+        try:
+            when = parse_iso(fixed)
+        except Exception:
+            when = None
+        if when is not None:
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=now_local.tzinfo)
+            if when <= now_local:
+                del _LLM_CACHE[key]
+                return None
+    return hit
+
+def _llm_cache_get(key: tuple):
+    entry = _LLM_CACHE.get(key)
+    if entry is None:
+        return None
+    if entry[2] <= time.monotonic():
+        del _LLM_CACHE[key]
+        return None
+    _LLM_CACHE.move_to_end(key)
+    return entry
+
+def _llm_cache_put(key: tuple, result: dict, delta: float | None, ttl: float):
+    _LLM_CACHE[key] = (result, delta, time.monotonic() + ttl)
+    if len(_LLM_CACHE) > _LLM_CACHE_MAX:
+        _LLM_CACHE.popitem(last=False)
+
+async def call_llm(user_text: str, user_tz: str, now_iso_override: str | None = None,
+                   ctx_injection: dict | None = None) -> LLMResult:
     """Возвращает dict-инструкцию.
 
        Ожидаемые ключи (по контракту prompts.yaml/parse.system):
@@ -278,24 +594,44 @@ async def call_llm(user_text: str, user_tz: str, now_iso_override: str | None =
          - fixed_datetime: iso | null
          - recurrence: {...} | null
          - expects/question/variants для уточнений
+       ctx_injection — CTX_* строки текущего уточнения; передаётся явно, без глобального состояния.
     """
     now_local = now_in_user_tz(user_tz)
     if now_iso_override:
-        try: now_local = dparser.isoparse(now_iso_override)
+        try: now_local = parse_iso(now_iso_override)
         except Exception: pass
-    header = f"NOW_ISO={now_local.replace(microsecond=0).isoformat()}\nTZ_DEFAULT={user_tz or '+03:00'}"
 
-    messages = [
-        {"role": "system", "content": PROMPTS["system"]},
-        {"role": "system", "content": header},
-        {"role": "system", "content": PROMPTS["parse"]["system"]},
-    ]
+    use_cache = _LLM_CACHE_MAX > 0 and not now_iso_override and not ctx_injection
+    key = _llm_cache_key(user_text, user_tz)
+    hour_key = _llm_hour_key(key, now_local)
+    # оба ключа — через _llm_cache_hit: «в 10:30» из часового кэша в 10:40 уже в прошлом
+    hit = (_llm_cache_hit(key, now_local) or _llm_cache_hit(hour_key, now_local)) if use_cache else None
+    if hit:
+        log.debug("LLM cache hit: %r", key)
+        return hit
+    data = await _llm_fetch(user_text, user_tz, now_local, now_iso_override, ctx_injection)
+    if use_cache and data:
+        entry = _llm_cache_entry(key[0], data, now_local)
+        if entry:
+            _llm_cache_put(key, *entry, _LLM_CACHE_TTL)
+        elif _llm_hour_cacheable(key[0], data):
+            _llm_cache_put(hour_key, dict(data), None, min(3600, _LLM_CACHE_TTL))
+    return data
+
+async def _llm_fetch(user_text: str, user_tz: str, now_local: datetime, now_iso_override: str | None,
+                     ctx_injection: dict | None) -> LLMResult:
+    """Сам запрос к модели: сообщения, вызов API, разбор JSON."""
+    now_iso = now_local.replace(microsecond=0).isoformat() if now_iso_override else now_iso_for_tz(user_tz)
+    header = f"NOW_ISO={now_iso}\nTZ_DEFAULT={user_tz or '+03:00'}"
+
+    # статичный префикс идёт первым и не меняется между вызовами —
+    # OpenAI кэширует его; NOW/TZ и CTX_* — в хвосте
+    messages = [*_BASE_MESSAGES, {"role": "system", "content": header}]
 
     # --- инъекция контекста уточнения (если есть)
     ctx_lines = []
     try:
-        global _CTX_INJECTION
-        for k, v in (_CTX_INJECTION or {}).items():
+        for k, v in (ctx_injection or {}).items():
             if v is None:
                 continue
             if isinstance(v, str) and not (v.startswith("{") or v.startswith("[")):
@@ -307,69 +643,110 @@ async def call_llm(user_text: str, user_tz: str, now_iso_override: str | None =
     if ctx_lines:
         messages.append({"role": "system", "content": "\n".join(ctx_lines)})
 
-    messages.extend(PROMPTS.get("fewshot") or [])
     messages.append({"role": "user", "content": user_text})
 
     client = get_openai()
-    resp = client.chat.completions.create(
+    resp = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
-        temperature=0.2
+        temperature=0.2,
+        # JSON-режим + потолок длины: модель не «разговаривается» и отдаёт
+        # ровно один объект, хвост латентности ограничен
+        response_format={"type": "json_object"},
+        max_tokens=LLM_MAX_TOKENS,
     )
     txt = (resp.choices[0].message.content or "").strip()
     log.debug("LLM raw response: %s", txt)
-    m = re.search(r"\{[\s\S]+\}", txt)
-    payload = m.group(0) if m else txt
+    # в JSON-режиме ответ — ровно объект: один проход парсера без копий;
+    # иначе — от первой «{» до последней «}», линейно, без бэктрекинга regex
     try:
-        return json.loads(payload)
-    except Exception:
-        log.exception("LLM JSON parse failed. Raw: %s", txt)
+        data = json_loads(txt)
+    except ValueError:
+        i, j = txt.find("{"), txt.rfind("}")
+        try:
+            data = json_loads(txt[i:j + 1] if 0 <= i < j else txt)
+        except Exception:
+            log.exception("LLM JSON parse failed. Raw: %s", txt)
+            return {}
+    if not isinstance(data, dict):
+        log.warning("LLM JSON is not an object: %r", data)
         return {}
+    return _coerce_llm_result(data)
 
 # ---------- Rule-based quick parse ----------
-def _clean_spaces(s: str) -> str: return re.sub(r"\s+", " ", s).strip()
+_MULTISPACE = re.compile(r"\s+")
+def _clean_spaces(s: str) -> str: return _MULTISPACE.sub(" ", s).strip()
+# день и «через …» — одна альтернация, один проход sub. «в 10[:30] [часов]» — отдельно и после:
+# вырезанный день может сблизить «в … N» («в сегодня 3» -> «в 3»), в общем проходе это бы потерялось
+_TITLE_DAY_REL_RX = re.compile(r"\b(?:сегодня|завтра|послезавтра)\b|\bчерез\b\s+[^,;.]+", re.IGNORECASE)
+_TITLE_AT_RX = re.compile(r"\bв\s+\d{1,2}(?::\d{2})?\s*(?:час(?:а|ов)?|ч)?\b", re.IGNORECASE)
+_TITLE_AT_SHORT_RX = re.compile(r"\bв\s+\d{1,2}\b", re.IGNORECASE)  # «в в 3 4»: остаток после первого прохода
+
 def _extract_title(text: str) -> str:
     t = text
-    t = re.sub(r"\b(сегодня|завтра|послезавтра)\b", " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\bчерез\b\s+[^,;.]+", " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\bв\s+\d{1,2}(:\d{2})?\s*(час(?:а|ов)?|ч)?\b", " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\bв\s+\d{1,2}\b", " ", t, flags=re.IGNORECASE)
+    low = t.lower()
+    # regex только если в тексте есть что вырезать
+    if "сегодня" in low or "завтра" in low or "через" in low:
+        t = _TITLE_DAY_REL_RX.sub(" ", t)
+    if any(ch.isdigit() for ch in low):
+        t = _TITLE_AT_RX.sub(" ", t)
+        t = _TITLE_AT_SHORT_RX.sub(" ", t)
     t = _clean_spaces(t.strip(" ,.;—-"))
     return t.capitalize() if t else "Напоминание"
 
+# все ветки rule_parse требуют одного из этих слов — дешёвый отсев «привет/спасибо»
+# подстроки: `in` по литералу дешевле re.search («послезавтра» ловится по «завтра»)
+_RULE_HINT_WORDS = ("кажд", "через", "сегодня", "завтра")
+
+_REL_RX = re.compile(
+    r"\bчерез\s+(?:(?P<half>полчаса)|(?P<one>минуту)|(?P<nmin>\d+)\s*мин(?:ут)?|(?P<nh>\d+)\s*час(?:а|ов)?)\b"
+)
+# «каждые 15 мин» / «каждую минуту» — одна альтернация, ветка по lastgroup
+_INTERVAL_RX = re.compile(
+    r"\bкажды[ей]\s+(?P<n>\d+)\s*(?P<unit>сек|секунд\w*|мин\w*|час\w*)\b"
+    r"|\bкажд(?:ую|ый)\s+(?P<one>минут[уы]?)\b"
+)
+_DAY_WORD_RX = re.compile(r"\b(сегодня|завтра|послезавтра)\b")
+_DAY_WORD_SHIFT = {"сегодня": 0, "завтра": 1, "послезавтра": 2}  # сдвиг в днях для группы _DAY_WORD_RX
+_AT_TIME_RX = re.compile(r"\bв\s+(\d{1,2})(?::?(\d{2}))?\b")       # «в 11», «в 11:40», «в 1140»
+_BARE_TIME_RX = re.compile(r"\b\d{1,2}(?::\d{2})?\b")  # любое «9» / «09:30», с предлогом или без
+# «в 9», «в 09», «в 9:30», «09:30» — обе формы одной альтернацией, один search
+_HAS_TIME_RX = re.compile(r"\bв\s+\d{1,2}(?::\d{2})?\b|\b\d{1,2}:\d{2}\b")
+_RULE_MAX_LEN = 500  # длиннее — не напоминание, не гоняем regex по простыне
+
 def rule_parse(text: str, now_local: datetime):
-    s = text.strip().lower()
+    s = text.strip().lower()[:_RULE_MAX_LEN]
+    if not any(w in s for w in _RULE_HINT_WORDS):
+        return None
 
-    # интервалы: «каждые 15 мин», «каждый час»
-    m_int = re.search(r"\bкажды(е|й)\s+(\d+)\s*(сек|секунд\w*|мин\w*|час\w*)\b", s)
+    # интервалы: «каждые 15 мин», «каждый час» — без «кажд» regex не нужен
+    m_int = _INTERVAL_RX.search(s) if "кажд" in s else None
     if m_int:
-        n = int(m_int.group(2))
-        unit_raw = m_int.group(3)
-        unit = "second" if unit_raw.startswith("сек") else ("minute" if unit_raw.startswith("мин") else "hour")
+        if m_int.lastgroup == "one":
+            n, unit = 1, "minute"
+        else:
+            n = int(m_int.group("n"))
+            unit_raw = m_int.group("unit")
+            unit = "second" if unit_raw.startswith("сек") else ("minute" if unit_raw.startswith("мин") else "hour")
         return {"intent": "create_reminder", "title": _extract_title(text),
                 "recurrence": {"type": "interval", "unit": unit, "n": n, "start_at": now_local.replace(microsecond=0).isoformat()}}
 
-    if re.search(r"\bкажд(ую|ый)\s+минут(у|ы)?\b", s):
-        return {"intent": "create_reminder", "title": _extract_title(text),
-                "recurrence": {"type": "interval", "unit": "minute", "n": 1, "start_at": now_local.replace(microsecond=0).isoformat()}}
-
-    # «через …»
-    if re.search(r"\bчерез\s+(полчаса|минуту|\d+\s*мин(?:ут)?|\d+\s*час(?:а|ов)?)\b", s):
-        m = re.search(r"через\s+(полчаса|минуту|\d+\s*мин(?:ут)?|\d+\s*час(?:а|ов)?)", s)
-        delta = timedelta()
-        ch = m.group(1)
-        if "полчаса" in ch: delta = timedelta(minutes=30)
-        elif "минуту" in ch: delta = timedelta(minutes=1)
-        elif "мин" in ch: delta = timedelta(minutes=int(re.search(r"\d+", ch).group()))
-        else: delta = timedelta(hours=int(re.search(r"\d+", ch).group()))
+    # «через …» — один проход, ветка по имени сработавшей группы
+    m = _REL_RX.search(s) if "через" in s else None
+    if m:
+        kind = m.lastgroup
+        if kind == "half": delta = timedelta(minutes=30)
+        elif kind == "one": delta = timedelta(minutes=1)
+        elif kind == "nmin": delta = timedelta(minutes=int(m.group("nmin")))
+        else: delta = timedelta(hours=int(m.group("nh")))
         when_local = now_local + delta
         return {"intent": "create_reminder", "title": _extract_title(text), "fixed_datetime": when_local.replace(microsecond=0).isoformat()}
 
     # «завтра/сегодня/послезавтра в 11[:40]»
-    md = re.search(r"\b(сегодня|завтра|послезавтра)\b", s)
-    mt = re.search(r"\bв\s+(\d{1,2})(?::?(\d{2}))?\b", s)
+    md = _DAY_WORD_RX.search(s)
+    mt = _AT_TIME_RX.search(s)
     if md and mt:
-        base = {"сегодня": 0, "завтра": 1, "послезавтра": 2}[md.group(1)]
+        base = _DAY_WORD_SHIFT[md.group(1)]
         day = (now_local + timedelta(days=base)).date()
         hh = int(mt.group(1)); mm = int(mt.group(2) or 0)
         title = _extract_title(text)
@@ -380,7 +757,7 @@ def rule_parse(text: str, now_local: datetime):
         return {"intent": "create_reminder", "title": title, "fixed_datetime": when_local.replace(microsecond=0).isoformat()}
         # есть слово-дата, но ВРЕМЕНИ нет -> спросим время и положим base_date
     if md and not mt:
-        base = {"сегодня": 0, "завтра": 1, "послезавтра": 2}[md.group(1)]
+        base = _DAY_WORD_SHIFT[md.group(1)]
         day = (now_local + timedelta(days=base)).date()
         title = _extract_title(text)
         return {
@@ -413,6 +790,20 @@ def db_set_user_tz(user_id: int, tz: str):
             conn.execute("insert or replace into users(user_id, tz) values(?,?)", (user_id, tz))
             conn.commit()
 
+async def get_user_tz(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str | None:
+    """TZ из user_data (переживает рестарт через PicklePersistence), иначе из БД."""
+    tz = context.user_data.get("tz")
+    if tz:
+        return tz
+    tz = await asyncio.to_thread(db_get_user_tz, user_id)
+    if tz:
+        context.user_data["tz"] = tz
+    return tz
+
+async def set_user_tz(context: ContextTypes.DEFAULT_TYPE, user_id: int, tz: str):
+    await asyncio.to_thread(db_set_user_tz, user_id, tz)
+    context.user_data["tz"] = tz
+
 def db_add_reminder_oneoff(user_id: int, title: str, body: str | None, when_iso_utc: str) -> int:
     with db() as conn:
         if DB_DIALECT == "postgres":
@@ -429,10 +820,36 @@ def db_add_reminder_oneoff(user_id: int, title: str, body: str | None, when_iso_
             conn.commit()
             return cur.lastrowid
 
+def db_add_children(user_id: int, title: str, body: str | None, parent_id: int,
+                    children: list[tuple[str, int]]) -> list[int]:
+    """Предупреждения к parent_id одним соединением и одной транзакцией.
+    children — [(when_iso_utc, offset_minutes)], возвращает id в том же порядке."""
+    ids = []
+    with db() as conn:
+        if DB_DIALECT == "postgres":
+            with conn.transaction():
+                for when_iso_utc, offset in children:
+                    r = conn.execute(
+                        "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
+                        "values(%s,%s,%s,%s,'scheduled','oneoff',%s,%s) returning id",
+                        (user_id, title, body, when_iso_utc, parent_id, offset)
+                    ).fetchone()
+                    ids.append(r["id"])
+        else:
+            for when_iso_utc, offset in children:
+                cur = conn.execute(
+                    "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
+                    "values(?,?,?,?, 'scheduled','oneoff',?,?)",
+                    (user_id, title, body, when_iso_utc, parent_id, offset)
+                )
+                ids.append(cur.lastrowid)
+            conn.commit()
+    return ids
+
 def db_add_reminder_recurring(user_id: int, title: str, body: str | None, recurrence: dict, tz: str) -> int:
     rec = dict(recurrence or {})
     if "tz" not in rec: rec["tz"] = tz
-    rec_json = json.dumps(rec, ensure_ascii=False)
+    rec_json = json_dumps(rec)
     with db() as conn:
         if DB_DIALECT == "postgres":
             r = conn.execute(
@@ -450,13 +867,17 @@ def db_add_reminder_recurring(user_id: int, title: str, body: str | None, recurr
             conn.commit()
             return cur.lastrowid
 
-def db_delete(rem_id: int):
+def db_delete_cascade(rem_id: int) -> list[int]:
+    """Удаляет напоминание вместе с предупреждениями одним delete; возвращает id удалённых детей."""
     with db() as conn:
         if DB_DIALECT == "postgres":
-            conn.execute("delete from reminders where id=%s", (rem_id,))
-        else:
-            conn.execute("delete from reminders where id=?", (rem_id,))
-            conn.commit()
+            rows = conn.execute(
+                "delete from reminders where id=%s or parent_id=%s returning id", (rem_id, rem_id)
+            ).fetchall()
+            return [r["id"] for r in rows if r["id"] != rem_id]
+        kids = [k[0] for k in conn.execute("select id from reminders where parent_id=?", (rem_id,)).fetchall()]
+        conn.execute("delete from reminders where id=? or parent_id=?", (rem_id, rem_id)); conn.commit()
+        return kids
 
 def db_mark_done(rem_id: int):
     with db() as conn:
@@ -474,8 +895,9 @@ def db_get_reminder(rem_id: int):
             r = conn.execute("select * from reminders where id=?", (rem_id,)).fetchone()
         return r
 
-def db_snooze(rem_id: int, minutes: int) -> tuple[str, str | None]:
-    """Возвращает (kind, new_when_iso) — для recurring new_when_iso одноразово."""
+def db_snooze(rem_id: int, minutes: int) -> tuple[str, dict | None]:
+    """Возвращает (kind, row) — row уже с новым when_iso (для oneoff), повторный select не нужен.
+    Для recurring строка не меняется: откладывается одноразовый джоб."""
     with db() as conn:
         if DB_DIALECT == "postgres":
             row = conn.execute("select * from reminders where id=%s", (rem_id,)).fetchone()
@@ -483,24 +905,26 @@ def db_snooze(rem_id: int, minutes: int) -> tuple[str, str | None]:
             row = conn.execute("select * from reminders where id=?", (rem_id,)).fetchone()
 
         if not row: return "missing", None
+        row = dict(row)
         kind = (row["kind"] or "oneoff").lower()
         if kind == "oneoff":
-            new_iso = iso_utc(dparser.isoparse(row["when_iso"]).astimezone(timezone.utc) + timedelta(minutes=minutes))
+            new_iso = iso_utc(parse_iso(row["when_iso"]).astimezone(timezone.utc) + timedelta(minutes=minutes))
             if DB_DIALECT == "postgres":
                 conn.execute("update reminders set when_iso=%s where id=%s", (new_iso, rem_id))
             else:
                 conn.execute("update reminders set when_iso=? where id=?", (new_iso, rem_id)); conn.commit()
-            return kind, new_iso
-        else:
-            new_iso = iso_utc(datetime.now(timezone.utc) + timedelta(minutes=minutes))
-            return kind, new_iso
+            row["when_iso"] = new_iso
+        return kind, row
 
 def db_future(user_id: int):
+    """Будущие напоминания + TZ владельца (колонка user_tz) — один запрос на /list."""
     with db() as conn:
         q = (
-            "select * from reminders where user_id=%s and status='scheduled' and parent_id is null order by id desc"
+            "select r.*, u.tz as user_tz from reminders r left join users u on u.user_id = r.user_id "
+            "where r.user_id=%s and r.status='scheduled' and r.parent_id is null order by r.id desc"
             if DB_DIALECT == "postgres"
-            else "select * from reminders where user_id=? and status='scheduled' and parent_id is null order by id desc"
+            else "select r.*, u.tz as user_tz from reminders r left join users u on u.user_id = r.user_id "
+                 "where r.user_id=? and r.status='scheduled' and r.parent_id is null order by r.id desc"
         )
         try:
             cur = conn.execute(q, (user_id,))
@@ -516,14 +940,7 @@ TG_BOT = None
 
 async def fire_reminder(*, chat_id: int, rem_id: int, title: str, kind: str = "oneoff"):
     try:
-        kb_rows = [[
-            InlineKeyboardButton("Через 10 мин", callback_data=f"snooze:10:{rem_id}"),
-            InlineKeyboardButton("Через 1 час", callback_data=f"snooze:60:{rem_id}")
-        ]]
-        if kind == "oneoff":
-            kb_rows.append([InlineKeyboardButton("✅", callback_data=f"done:{rem_id}")])
-
-        await TG_BOT.send_message(chat_id, f"🔔 «{title}»", reply_markup=InlineKeyboardMarkup(kb_rows))
+        await TG_BOT.send_message(chat_id, f"🔔 «{title}»", reply_markup=fire_kb(rem_id, kind))
         log.info("Fired reminder id=%s to chat=%s", rem_id, chat_id)
     except Exception as e:
         log.exception("fire_reminder failed: %s", e)
@@ -533,18 +950,22 @@ def ensure_scheduler() -> AsyncIOScheduler:
         raise RuntimeError("Scheduler not initialized yet")
     return scheduler
 
-def schedule_oneoff(rem_id: int, user_id: int, when_iso_utc: str, title: str, kind: str = "oneoff"):
+def schedule_oneoff(rem_id: int, user_id: int, when_utc: str | datetime, title: str, kind: str = "oneoff",
+                    log_jobs: bool = True):
+    """when_utc — ISO из БД или уже готовый aware datetime (тогда без повторного разбора)."""
     sch = ensure_scheduler()
-    dt_utc = dparser.isoparse(when_iso_utc)
+    dt_utc = when_utc if isinstance(when_utc, datetime) else parse_iso(when_utc)
     sch.add_job(
         fire_reminder, DateTrigger(run_date=dt_utc),
         id=f"rem-{rem_id}", replace_existing=True, misfire_grace_time=300, coalesce=True,
         kwargs={"chat_id": user_id, "rem_id": rem_id, "title": title, "kind": kind},
         name=f"rem {rem_id}",
     )
-    sch.print_jobs()
+    if log_jobs and log.isEnabledFor(logging.DEBUG):
+        sch.print_jobs()
 
-def schedule_recurring(rem_id: int, user_id: int, title: str, recurrence: dict, tz_str: str):
+def schedule_recurring(rem_id: int, user_id: int, title: str, recurrence: dict, tz_str: str,
+                       log_jobs: bool = True):
     sch = ensure_scheduler()
     rtype = (recurrence.get("type") or "").lower()
 
@@ -552,7 +973,7 @@ def schedule_recurring(rem_id: int, user_id: int, title: str, recurrence: dict,
         unit = (recurrence.get("unit") or "").lower()
         n = int(recurrence.get("n") or 1)
         start_at = recurrence.get("start_at")
-        start_dt_local = dparser.isoparse(start_at) if start_at else now_in_user_tz(tz_str)
+        start_dt_local = parse_iso(start_at) if start_at else now_in_user_tz(tz_str)
         start_dt_utc = start_dt_local.astimezone(timezone.utc)
         kwargs = {}
         if unit == "second":
@@ -584,37 +1005,48 @@ def schedule_recurring(rem_id: int, user_id: int, title: str, recurrence: dict,
         kwargs={"chat_id": user_id, "rem_id": rem_id, "title": title, "kind": "recurring"},
         name=f"rem {rem_id}",
     )
-    sch.print_jobs()
+    if log_jobs and log.isEnabledFor(logging.DEBUG):
+        sch.print_jobs()
 
 def reschedule_all():
     sch = ensure_scheduler()
     with db() as conn:
-        rows = conn.execute("select * from reminders where status='scheduled'").fetchall()
+        # только нужные колонки; sqlite3.Row и dict_row оба отдают r["..."] — копия в dict не нужна
+        rows = conn.execute(
+            "select id, user_id, title, kind, when_iso, recurrence_json from reminders where status='scheduled'"
+        ).fetchall()
     for r in rows:
-        row = dict(r) if not isinstance(r, dict) else r
-        if (row.get("kind") or "oneoff") == "oneoff" and row.get("when_iso"):
-            schedule_oneoff(row["id"], row["user_id"], row["when_iso"], row["title"], kind="oneoff")
+        if (r["kind"] or "oneoff") == "oneoff" and r["when_iso"]:
+            schedule_oneoff(r["id"], r["user_id"], r["when_iso"], r["title"], kind="oneoff", log_jobs=False)
         else:
-            rec = json.loads(row.get("recurrence_json") or "{}")
+            rec = json_loads(r["recurrence_json"] or "{}")
             tz = rec.get("tz") or "+03:00"
             if rec:
-                schedule_recurring(row["id"], row["user_id"], row["title"], rec, tz)
+                schedule_recurring(r["id"], r["user_id"], r["title"], rec, tz, log_jobs=False)
     log.info("Rescheduled %d reminders from DB", len(rows))
+    # дамп расписания — один раз на весь набор, а не O(N) раз внутри цикла
+    if log.isEnabledFor(logging.DEBUG):
+        sch.print_jobs()
 
 # ---------- RU wording ----------
+# готовые фразы по коду дня — словарь строится один раз, а не на каждый вызов
+_RU_WEEKLY = {
+    "mon": "каждый понедельник",
+    "tue": "каждый вторник",
+    "wed": "каждую среду",
+    "thu": "каждый четверг",
+    "fri": "каждую пятницу",
+    "sat": "каждую субботу",
+    "sun": "каждое воскресенье",
+}
+
 def ru_weekly_phrase(weekday_code: str) -> str:
-    mapping = {
-        "mon": ("каждый", "понедельник"),
-        "tue": ("каждый", "вторник"),
-        "wed": ("каждую", "среду"),
-        "thu": ("каждый", "четверг"),
-        "fri": ("каждую", "пятницу"),
-        "sat": ("каждую", "субботу"),
-        "sun": ("каждое", "воскресенье"),
-    }
-    det, word = mapping.get((weekday_code or "").lower(), ("каждый", weekday_code or "день"))
-    return f"{det} {word}"
+    code = weekday_code or ""
+    # модель отдаёт «mon»/«tue» — точное совпадение без .lower(); регистр чиним только на промахе
+    phrase = _RU_WEEKLY.get(code) or _RU_WEEKLY.get(code.lower())
+    return phrase or f"каждый {weekday_code or 'день'}"
 
+@lru_cache(maxsize=128)
 def _format_interval_phrase(unit: str, n: int) -> str:
     unit = (unit or "").lower()
     n = int(n or 1)
@@ -630,9 +1062,11 @@ def format_reminder_line(row, user_tz: str) -> str:
     title = row.get("title", "Напоминание")
     kind = (row.get("kind") or "oneoff").lower()
     if kind == "oneoff" and row.get("when_iso"):
-        dt_local = to_user_local(row["when_iso"], user_tz)
-        return f"{dt_local.strftime('%d.%m в %H:%M')} — «{title}»"
-    rec = json.loads(row.get("recurrence_json") or "{}")
+        return f"{fmt_utc_iso(row['when_iso'], user_tz)} — «{title}»"
+    return format_recurrence_line(json_loads(row.get("recurrence_json") or "{}"), title)
+
+def format_recurrence_line(rec: dict, title: str) -> str:
+    """Строка для повторяющегося напоминания прямо из dict recurrence."""
     rtype = (rec.get("type") or "").lower()
     time_str = rec.get("time") or "00:00"
     if rtype == "interval":
@@ -649,17 +1083,20 @@ def format_reminder_line(row, user_tz: str) -> str:
     day = int(rec.get("day", 1))
     return f"каждое {day}-е число в {time_str} — «{title}»"
 
+# подпись кнопки в /list: широкий пробел растягивает кнопку на ширину сообщения
+_DEL_LABEL = "Удалить " + "⠀" * 20
+
 # ---------- Handlers ----------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    tz = db_get_user_tz(user_id)
+    tz = await get_user_tz(context, user_id)
     if not tz:
         await safe_reply(update,
             "Для начала укажи свой часовой пояс.\n"
             "Выбери город или пришли вручную смещение (+03:00) или IANA (Europe/Moscow).",
             reply_markup=MAIN_MENU_KB
         )
-        await safe_reply(update, "Выбери из списка:", reply_markup=build_tz_inline_kb())
+        await safe_reply(update, "Выбери из списка:", reply_markup=TZ_INLINE_KB)
         return
     await safe_reply(update, f"Часовой пояс установлен: {tz}\nТеперь напиши что и когда напомнить.",
                      reply_markup=MAIN_MENU_KB)
@@ -668,7 +1105,7 @@ async def try_handle_tz_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not update.message or not update.message.text: return False
     tz = parse_tz_input(update.message.text.strip())
     if tz is None: return False
-    db_set_user_tz(update.effective_user.id, tz)
+    await set_user_tz(context, update.effective_user.id, tz)
     await safe_reply(update, f"Часовой пояс установлен: {tz}\nТеперь напиши что и когда напомнить.",
                      reply_markup=MAIN_MENU_KB)
     return True
@@ -680,18 +1117,20 @@ async def cb_tz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = data.split(":",1)[1]; chat_id = q.message.chat.id
     if value == "other":
         await q.edit_message_text("Пришли смещение вида +03:00 или IANA-зону (Europe/Moscow)."); return
-    db_set_user_tz(chat_id, value)
+    await set_user_tz(context, chat_id, value)
     await q.edit_message_text(f"Часовой пояс установлен: {value}\nТеперь напиши что и когда напомнить.")
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        rows = db_future(user_id)
+        rows = await asyncio.to_thread(db_future, user_id)
         if not rows:
             return await safe_reply(update, "Будущих напоминаний нет.", reply_markup=MAIN_MENU_KB)
-        tz = db_get_user_tz(user_id) or "+03:00"
+        # TZ пришёл в той же выборке — отдельный запрос в users не нужен
+        tz = context.user_data.get("tz") or rows[0]["user_tz"]
+        if tz: context.user_data["tz"] = tz
+        tz = tz or "+03:00"
         await safe_reply(update, "🗓 Ближайшие напоминания —")
-        PAD = "⠀" * 20
         for r in rows:
             try:
                 line = format_reminder_line(r, tz)
@@ -699,90 +1138,86 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 log.exception("format_reminder_line failed on row=%r", r)
                 title = r.get("title") if isinstance(r, dict) else (r["title"] if r else "Напоминание")
                 line = f"«{title}» (некорректные данные)"
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"Удалить {PAD}", callback_data=f"del:{r['id']}")]])
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton(_DEL_LABEL, callback_data=f"del:{r['id']}")]])
             await safe_reply(update, line, reply_markup=kb)
-            await asyncio.sleep(0.05)
+            # с AIORateLimiter темп держит сам бот; ручная пауза — только без него
+            if context.bot.rate_limiter is None:
+                await asyncio.sleep(0.05)
     except Exception:
         log.exception("cmd_list fatal")
         return await safe_reply(update, "Не удалось получить список. Попробуй ещё раз.", reply_markup=MAIN_MENU_KB)
 
-async def cb_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    data = q.data or ""
-    if data.startswith("del:"):
-        rem_id = int(data.split(":")[1]); 
-        # каскад: снять джобы детей и удалить их
-        try:
-            with db() as conn:
-                if DB_DIALECT == "postgres":
-                    kids = conn.execute("select id from reminders where parent_id=%s", (rem_id,)).fetchall()
-                else:
-                    kids = conn.execute("select id from reminders where parent_id=?", (rem_id,)).fetchall()
-            sch = ensure_scheduler()
-            for k in (kids or []):
-                kid_id = k["id"] if isinstance(k, dict) else k[0]
-                job = sch.get_job(f"rem-{kid_id}")
-                if job: job.remove()
-            with db() as conn:
-                if DB_DIALECT == "postgres":
-                    conn.execute("delete from reminders where parent_id=%s", (rem_id,))
-                else:
-                    conn.execute("delete from reminders where parent_id=?", (rem_id,)); conn.commit()
-        except Exception:
-            log.exception("cascade delete children failed")
-
-        db_delete(rem_id)
-        sch = ensure_scheduler(); job = sch.get_job(f"rem-{rem_id}")
-        if job: job.remove()
-        await q.edit_message_text("Удалено ✅"); return
-    if data.startswith("snooze:"):
-        _, mins, rem_id = data.split(":"); rem_id = int(rem_id); mins = int(mins)
-        kind, _ = db_snooze(rem_id, mins); row = db_get_reminder(rem_id)
-        if not row: return await q.edit_message_text("Ошибка: напоминание не найдено.")
-        if kind == "oneoff":
-            schedule_oneoff(rem_id, row["user_id"], row["when_iso"], row["title"], kind="oneoff")
-            await q.edit_message_text(f"⏲ Отложено на {mins} мин.")
-        else:
-            when = iso_utc(datetime.now(timezone.utc) + timedelta(minutes=mins))
-            sch = ensure_scheduler()
-            sch.add_job(
-                fire_reminder, DateTrigger(run_date=dparser.isoparse(when)),
-                id=f"snooze-{rem_id}", replace_existing=True, misfire_grace_time=60, coalesce=True,
-                kwargs={"chat_id": row["user_id"], "rem_id": rem_id, "title": row["title"], "kind":"oneoff"},
-                name=f"snooze {rem_id}",
-            )
-            await q.edit_message_text(f"⏲ Отложено на {mins} мин. (одноразово)")
-        return
-    if data.startswith("done:"):
-        rem_id = int(data.split(":")[1]); db_mark_done(rem_id)
-        sch = ensure_scheduler(); job = sch.get_job(f"rem-{rem_id}")
+async def _cb_delete(q, payload: str):
+    rem_id = int(payload)
+    # каскад: родитель и предупреждения — одним запросом, затем снять их джобы
+    kids = await asyncio.to_thread(db_delete_cascade, rem_id)
+    sch = ensure_scheduler()
+    for jid in (rem_id, *kids):
+        job = sch.get_job(f"rem-{jid}")
         if job: job.remove()
-        await q.edit_message_text("✅ Выполнено"); return
+    await q.edit_message_text("Удалено ✅")
+
+async def _cb_snooze(q, payload: str):
+    mins, rem_id = payload.split(":"); rem_id = int(rem_id); mins = int(mins)
+    kind, row = await asyncio.to_thread(db_snooze, rem_id, mins)
+    if not row: return await q.edit_message_text("Ошибка: напоминание не найдено.")
+    if kind == "oneoff":
+        schedule_oneoff(rem_id, row["user_id"], row["when_iso"], row["title"], kind="oneoff")
+        await q.edit_message_text(f"⏲ Отложено на {mins} мин.")
+    else:
+        # datetime сразу, без круга iso_utc -> строка -> parse_iso
+        when = (_now_utc() + timedelta(minutes=mins)).replace(microsecond=0)
+        sch = ensure_scheduler()
+        sch.add_job(
+            fire_reminder, DateTrigger(run_date=when),
+            id=f"snooze-{rem_id}", replace_existing=True, misfire_grace_time=60, coalesce=True,
+            kwargs={"chat_id": row["user_id"], "rem_id": rem_id, "title": row["title"], "kind":"oneoff"},
+            name=f"snooze {rem_id}",
+        )
+        await q.edit_message_text(f"⏲ Отложено на {mins} мин. (одноразово)")
 
-async def cb_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _cb_done(q, payload: str):
+    rem_id = int(payload); await asyncio.to_thread(db_mark_done, rem_id)
+    sch = ensure_scheduler(); job = sch.get_job(f"rem-{rem_id}")
+    if job: job.remove()
+    await q.edit_message_text("✅ Выполнено")
+
+# «del:5», «snooze:10:5», «done:5» — префикс до первого «:» -> обработчик
+_CB_INLINE = {"del": _cb_delete, "snooze": _cb_snooze, "done": _cb_done}
+
+async def cb_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
+    prefix, _, payload = (q.data or "").partition(":")
+    fn = _CB_INLINE.get(prefix)
+    if fn: await fn(q, payload)
+
+async def _drop_markup(q):
     try: await q.edit_message_reply_markup(None)
     except Exception: pass
+
+async def cb_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    # ответ на callback и снятие кнопок — два независимых запроса, шлём разом
+    await asyncio.gather(q.answer(), _drop_markup(q))
     data = q.data or ""
     if not data.startswith("pick:"): return
     iso_local = data.split("pick:")[1]; user_id = q.message.chat.id
-    tz = db_get_user_tz(user_id) or "+03:00"
+    tz = await get_user_tz(context, user_id) or "+03:00"
     cs = get_clarify_state(context) or {}
     pre = context.user_data.get("prebuild") or {}
     title = cs.get("title") or pre.get("title") or "Напоминание"
-    when_local = dparser.isoparse(iso_local)
+    when_local = parse_iso(iso_local)
     if when_local.tzinfo is None: when_local = when_local.replace(tzinfo=tzinfo_from_user(tz))
     when_iso_utc = iso_utc(when_local)
-    rem_id = db_add_reminder_oneoff(user_id, title, None, when_iso_utc)
+    rem_id = await asyncio.to_thread(db_add_reminder_oneoff, user_id, title, None, when_iso_utc)
     schedule_oneoff(rem_id, user_id, when_iso_utc, title, kind="oneoff")
-    dt_local = to_user_local(when_iso_utc, tz)
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
-    await safe_reply(update, f"⏰ Окей, напомню «{title}» {dt_local.strftime('%d.%m в %H:%M')}", reply_markup=kb)
+    kb = cancel_kb(rem_id)
+    await safe_reply(update, f"⏰ Окей, напомню «{title}» {fmt_utc_iso(when_iso_utc, tz)}", reply_markup=kb)
 
 async def cb_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    try: await q.edit_message_reply_markup(None)
-    except Exception: pass
+    q = update.callback_query
+    # ответ на callback и снятие кнопок — два независимых запроса, шлём разом
+    await asyncio.gather(q.answer(), _drop_markup(q))
     data = q.data or ""
     if not data.startswith("answer:"): return
     choice = data.split("answer:",1)[1].strip()
@@ -790,10 +1225,10 @@ async def cb_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     base_date = cstate.get("base_date")
     title = cstate.get("title") or "Напоминание"
     user_id = q.message.chat.id
-    tz = db_get_user_tz(user_id) or "+03:00"
+    tz = await get_user_tz(context, user_id) or "+03:00"
 
     if base_date:
-        m = re.fullmatch(r"(\d{1,2})(?::?(\d{2}))?$", choice)
+        m = _HHMM_RX.fullmatch(choice)
         if m:
             hh = int(m.group(1)); mm = int(m.group(2) or 0)
             when_local = datetime.fromisoformat(base_date).replace(hour=hh, minute=mm, tzinfo=tzinfo_from_user(tz))
@@ -808,14 +1243,13 @@ async def cb_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         set_clarify_state(context, None)  # сбрасываем уточнения
-        rem_id = db_add_reminder_oneoff(user_id, title, None, when_iso_utc)
+        rem_id = await asyncio.to_thread(db_add_reminder_oneoff, user_id, title, None, when_iso_utc)
         schedule_oneoff(rem_id, user_id, when_iso_utc, title, kind="oneoff")
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
-        await safe_reply(update, f"⏰ Окей, напомню «{title}» {when_local.strftime('%d.%m в %H:%M')}", reply_markup=kb)
+        kb = cancel_kb(rem_id)
+        await safe_reply(update, f"⏰ Окей, напомню «{title}» {fmt_local(when_local)}", reply_markup=kb)
         return        
 
-    context.user_data["__auto_answer"] = choice
-    await handle_text(update, context)
+    await process_text(update, context, choice)
 
 def get_clarify_state(context: ContextTypes.DEFAULT_TYPE):
     return context.user_data.get("clarify_state")
@@ -825,6 +1259,17 @@ def set_clarify_state(context: ContextTypes.DEFAULT_TYPE, state: dict | None):
     else: context.user_data["clarify_state"] = state
 
 # ---------- VOICE ----------
+_asr_model = None
+def _transcribe_local(audio: io.BytesIO) -> str:
+    """faster-whisper в потоке: OGG/Opus декодирует сам (PyAV), ffmpeg и аплоад не нужны."""
+    global _asr_model
+    if _asr_model is None:
+        from faster_whisper import WhisperModel
+        _asr_model = WhisperModel(ASR_MODEL, device="cpu", compute_type="int8")
+    audio.seek(0)
+    segments, _ = _asr_model.transcribe(audio, language="ru", vad_filter=True)
+    return "".join(seg.text for seg in segments)
+
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         voice = update.message.voice
@@ -833,57 +1278,70 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         tg_file = await voice.get_file()
 
-        with tempfile.TemporaryDirectory() as td:
-            in_path = os.path.join(td, f"voice_{update.message.message_id}.oga")
-            wav_path = os.path.join(td, f"voice_{update.message.message_id}.wav")
-
-            await tg_file.download_to_drive(custom_path=in_path)
+        # голосовое целиком в память — дальше в stdin ffmpeg или в локальный ASR, без временных файлов
+        buf = io.BytesIO()
+        await tg_file.download_to_memory(out=buf)
 
+        if ASR_BACKEND == "local":
+            try:
+                text = await asyncio.to_thread(_transcribe_local, buf)
+            except Exception as e:
+                log.exception("Local ASR error: %s", e)
+                return await safe_reply(update, "Не смог распознать голосовое. Попробуй текстом, пожалуйста.")
+        else:
+            # FLAC в stdout: без промежуточного WAV на диске и вдвое меньше аплоад
             proc = await asyncio.create_subprocess_exec(
-                "ffmpeg", "-y", "-i", in_path, "-ac", "1", "-ar", "16000", wav_path,
-                stdout=asyncio.subprocess.DEVNULL,
+                "ffmpeg", "-y", "-i", "pipe:0", "-ac", "1", "-ar", "16000", "-f", "flac", "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.DEVNULL,
             )
-            rc = await proc.wait()
-            if rc != 0 or not os.path.exists(wav_path):
-                log.error("ffmpeg convert failed rc=%s", rc)
+            audio, _ = await proc.communicate(input=buf.getbuffer())
+            if proc.returncode != 0 or not audio:
+                log.error("ffmpeg convert failed rc=%s", proc.returncode)
                 return await safe_reply(update, "Не смог распознать голосовое. Попробуй текстом, пожалуйста.")
 
             client = get_openai()
-            with open(wav_path, "rb") as f:
-                try:
-                    tr = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f,
-                        response_format="text",
-                        language="ru",
-                    )
-                    text = tr if isinstance(tr, str) else getattr(tr, "text", "")
-                except Exception as e:
-                    log.exception("Whisper transcription error: %s", e)
-                    return await safe_reply(update, "Не смог распознать голосовое. Попробуй текстом, пожалуйста.")
+            try:
+                tr = await client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(f"voice_{update.message.message_id}.flac", audio),
+                    response_format="text",
+                    language="ru",
+                )
+                text = tr if isinstance(tr, str) else getattr(tr, "text", "")
+            except Exception as e:
+                log.exception("Whisper transcription error: %s", e)
+                return await safe_reply(update, "Не смог распознать голосовое. Попробуй текстом, пожалуйста.")
 
         text = (text or "").strip()
         if not text:
             return await safe_reply(update, "Не смог распознать голосовое. Попробуй текстом, пожалуйста.")
 
-        context.user_data["__auto_answer"] = text
-        return await handle_text(update, context)
+        return await process_text(update, context, text)
 
     except Exception as e:
         log.exception("handle_voice failed: %s", e)
         return await safe_reply(update, "Ошибка обработки аудио")
 
 # ---------- PREBUILD (создание при «Готово») ----------
+_PREBUILD_OPTIONS = (
+    (10, "За 10 мин"),
+    (60, "За час"),
+    (180, "За 3 часа"),
+    (1440, "За день"),
+    (10080, "За неделю"),
+)
+# те же варианты строчными — для хвоста подтверждения «+ предупреждения: …»
+_PREBUILD_SUFFIX = {offset: label.lower() for offset, label in _PREBUILD_OPTIONS}
+# нижний ряд не зависит от выбора — кнопки неизменяемые, собираем один раз
+_PREBUILD_FOOTER = (
+    InlineKeyboardButton("✅ Готово", callback_data="pre2:save"),
+    InlineKeyboardButton("❌ Отмена", callback_data="pre2:cancel"),
+)
+
 def _prebuild_options(delta_min: int):
-    options = [
-        (10, "За 10 мин"),
-        (60, "За час"),
-        (180, "За 3 часа"),
-        (1440, "За день"),
-        (10080, "За неделю"),
-    ]
-    return [(m, lbl) for m, lbl in options if m <= delta_min]
+    return [(m, lbl) for m, lbl in _PREBUILD_OPTIONS if m <= delta_min]
 
 def _prebuild_keyboard(pre: dict, now_local: datetime):
     when_iso_utc = pre["when_iso_utc"]
@@ -897,19 +1355,11 @@ def _prebuild_keyboard(pre: dict, now_local: datetime):
     if not avail:
         return None, dt_local
 
-    rows = []
-    row = []
-    for i, (m, lbl) in enumerate(avail, 1):
-        mark = "✅ " if m in selected else "⬜ "
-        row.append(InlineKeyboardButton(mark + lbl, callback_data=f"pre2:toggle:{m}"))
-        if i % 2 == 0:
-            rows.append(row); row = []
-    if row: rows.append(row)
-    rows.append([
-        InlineKeyboardButton("✅ Готово", callback_data="pre2:save"),
-        InlineKeyboardButton("❌ Отмена", callback_data="pre2:cancel")
-    ])
-    kb = InlineKeyboardMarkup(rows)
+    buttons = (
+        InlineKeyboardButton(("✅ " if m in selected else "⬜ ") + lbl, callback_data=f"pre2:toggle:{m}")
+        for m, lbl in avail
+    )
+    kb = InlineKeyboardMarkup([*batched(buttons, 2), _PREBUILD_FOOTER])
     return kb, dt_local
 
 async def send_prebuild_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -920,11 +1370,11 @@ async def send_prebuild_poll(update: Update, context: ContextTypes.DEFAULT_TYPE)
     kb, dt_local = _prebuild_keyboard(pre, now_local)
     if kb is None:
         user_id = update.effective_user.id
-        rem_id = db_add_reminder_oneoff(user_id, pre["title"], None, pre["when_iso_utc"])
+        rem_id = await asyncio.to_thread(db_add_reminder_oneoff, user_id, pre["title"], None, pre["when_iso_utc"])
         schedule_oneoff(rem_id, user_id, pre["when_iso_utc"], pre["title"], kind="oneoff")
         context.user_data.pop("prebuild", None)
-        final_kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
-        await safe_reply(update, f"⏰ Окей, напомню «{pre['title']}» {dt_local.strftime('%d.%m в %H:%M')}", reply_markup=final_kb)
+        final_kb = cancel_kb(rem_id)
+        await safe_reply(update, f"⏰ Окей, напомню «{pre['title']}» {fmt_local(dt_local)}", reply_markup=final_kb)
         return
     await safe_reply(update, "Когда напомнить заранее? (можно несколько)", reply_markup=kb)
 
@@ -948,42 +1398,32 @@ async def cb_prebuild(update: Update, context: ContextTypes.DEFAULT_TYPE):
         when_iso_utc = pre["when_iso_utc"]
         tz = pre["user_tz"]
         selected = sorted(list(pre.get("selected", set())))
-        parent_id = db_add_reminder_oneoff(user_id, title, None, when_iso_utc)
-        schedule_oneoff(parent_id, user_id, when_iso_utc, title, kind="oneoff")
+        parent_id = await asyncio.to_thread(db_add_reminder_oneoff, user_id, title, None, when_iso_utc)
+        # разбор времени родителя и «сейчас» — один раз на весь набор
+        parent_utc = parse_iso(when_iso_utc).astimezone(timezone.utc)
+        schedule_oneoff(parent_id, user_id, parent_utc, title, kind="oneoff")
+        now_utc = _now_utc()
+        children, child_whens = [], []
         for offset in selected:
-            child_when_utc = dparser.isoparse(when_iso_utc).astimezone(timezone.utc) - timedelta(minutes=offset)
-            if child_when_utc <= datetime.now(timezone.utc):
+            child_when_utc = parent_utc - timedelta(minutes=offset)
+            if child_when_utc <= now_utc:
                 continue
-            with db() as conn:
-                if DB_DIALECT == "postgres":
-                    r = conn.execute(
-                        "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
-                        "values(%s,%s,%s,%s,'scheduled','oneoff',%s,%s) returning id",
-                        (user_id, title, None, iso_utc(child_when_utc), parent_id, offset)
-                    ).fetchone()
-                    child_id = r["id"]
-                else:
-                    cur = conn.execute(
-                        "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
-                        "values(?,?,?,?, 'scheduled','oneoff',?,?)",
-                        (user_id, title, None, iso_utc(child_when_utc), parent_id, offset)
-                    )
-                    conn.commit()
-                    child_id = cur.lastrowid
-            schedule_oneoff(child_id, user_id, iso_utc(child_when_utc), title, kind="oneoff")
+            children.append((iso_utc(child_when_utc), offset)); child_whens.append(child_when_utc)
+        if children:
+            child_ids = await asyncio.to_thread(db_add_children, user_id, title, None, parent_id, children)
+            for child_id, child_when_utc in zip(child_ids, child_whens):
+                schedule_oneoff(child_id, user_id, child_when_utc, title, kind="oneoff")
         context.user_data.pop("prebuild", None)
-        dt_local = to_user_local(when_iso_utc, tz)
         suffix = ""
         if selected:
-            mapping = {10:"за 10 мин",60:"за час",180:"за 3 часа",1440:"за день",10080:"за неделю"}
-            labels = [mapping[o] for o in selected if o in mapping]
+            labels = [_PREBUILD_SUFFIX[o] for o in selected if o in _PREBUILD_SUFFIX]
             suffix = "\n+ предупреждения: " + ", ".join(labels)
-        final_kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{parent_id}")]])
-        await q.edit_message_text(f"⏰ Окей, напомню «{title}» {dt_local.strftime('%d.%m в %H:%M')}{suffix}",
+        final_kb = cancel_kb(parent_id)
+        await q.edit_message_text(f"⏰ Окей, напомню «{title}» {fmt_utc_iso(when_iso_utc, tz)}{suffix}",
                                   reply_markup=final_kb)
         return
 
-    m = re.fullmatch(r"pre2:toggle:(\d+)", data)
+    m = _PRE2_TOGGLE_RX.fullmatch(data)
     if m:
         offset = int(m.group(1))
         sel = pre.get("selected", set())
@@ -1003,33 +1443,47 @@ async def cb_prebuild(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ---------- main text ----------
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global _CTX_INJECTION  # ← первая инструкция внутри функции
+# новая явная команда с датой/временем — повод сбросить висящее уточнение
+_NEW_REQUEST_RX = re.compile(
+    r"\b(сегодня|завтра|послезавтра|через|кажд(ый|ую|ое)|по\s+(пн|вт|ср|чт|пт|сб|вс)|в\s+\d{1,2}(:\d{2})?)\b"
+)
 
+# без единой зацепки за время/дату/повтор LLM не зовём: «привет», «ок», «спасибо» отвечаются локально.
+# Список нарочно широкий (основы слов) — ложное срабатывание стоит лишь вызова модели, пропуск — ответа пользователю
+_LLM_HINT_RX = re.compile(
+    r"\d|через|завтра|сегодня|утр|днём|днем|обед|вечер|ноч|полдень|полночь|"
+    r"понедельн|вторник|сред[аеуы]|четверг|пятниц|суббот|воскресен|выходн|будн|"
+    r"\b(пн|вт|ср|чт|пт|сб|вс)\b|час|минут|секунд|недел|месяц|год|числ|"
+    r"январ|феврал|март|апрел|ма[яй]|июн|июл|август|сентябр|октябр|ноябр|декабр|"
+    r"кажд|ежедн|еженед|ежемес|ежегод|напом|будиль|пол[её]|четверть|ровно"
+)
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 0) быстрые выходы
     if await try_handle_tz_input(update, context):
         return
+    text = update.message.text.strip() if update.message and update.message.text else ""
+    await process_text(update, context, text)
+
+async def process_text(update: Update, context: ContextTypes.DEFAULT_TYPE, incoming_text: str):
+    """Общий конвейер для текста, расшифровки голосового и ответа кнопкой-вариантом."""
 
     user_id = update.effective_user.id
-    incoming_text = (context.user_data.pop("__auto_answer", None)
-                     or (update.message.text.strip() if update.message and update.message.text else ""))
+    low = incoming_text.lower()  # один раз на сообщение; оригинал — для заголовков
 
     # (по желанию) сброс висящего уточнения на новую явную команду
-    if get_clarify_state(context) and re.search(
-        r"\b(сегодня|завтра|послезавтра|через|кажд(ый|ую|ое)|по\s+(пн|вт|ср|чт|пт|сб|вс)|в\s+\d{1,2}(:\d{2})?)\b",
-        incoming_text.lower()
-    ):
+    if get_clarify_state(context) and _NEW_REQUEST_RX.search(low):
         set_clarify_state(context, None)
 
-    if incoming_text == "📝 Список напоминаний" or incoming_text.lower() == "/list":
+    if incoming_text == "📝 Список напоминаний" or low == "/list":
         return await cmd_list(update, context)
-    if incoming_text == "⚙️ Настройки" or incoming_text.lower() == "/settings":
+    if incoming_text == "⚙️ Настройки" or low == "/settings":
         return await safe_reply(update, "Раздел «Настройки» в разработке.", reply_markup=MAIN_MENU_KB)
 
-    user_tz = db_get_user_tz(user_id)
+    user_tz = await get_user_tz(context, user_id)
     if not user_tz:
         await safe_reply(update, "Сначала укажи часовой пояс.", reply_markup=MAIN_MENU_KB)
-        await safe_reply(update, "Выбери из списка:", reply_markup=build_tz_inline_kb())
+        await safe_reply(update, "Выбери из списка:", reply_markup=TZ_INLINE_KB)
         return
 
     now_local = now_in_user_tz(user_tz)
@@ -1042,7 +1496,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         prev_title = cs.get("title") or ""
         prev_q = cs.get("question") or ""
         prev_expects = cs.get("expects") or ("time" if base_date else None)
-        _CTX_INJECTION = {
+        ctx_injection = {
             "CTX_PREV_TEXT": context.user_data.get("__last_user_text_prev", "") or "",
             "CTX_PREV_TITLE": prev_title or "",
             "CTX_PREV_QUESTION": prev_q or "",
@@ -1051,7 +1505,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "CTX_SLOT_TITLE": prev_title or None,
         }
     else:
-        _CTX_INJECTION = {}
+        ctx_injection = {}
 
     # запомним текущую фразу как «предыдущую» для следующего шага
     context.user_data["__last_user_text_prev"] = incoming_text
@@ -1068,13 +1522,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # распознаем отдельные ответы
         txt = incoming_text.strip()
-        m_time = re.fullmatch(r"(\d{1,2})(?::?(\d{2}))?$", txt)
-        m_ddmm = re.fullmatch(r"(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?", txt)
-        m_rel = re.search(r"\b(сегодня|завтра|послезавтра)\b", txt.lower())
+        m_time = _HHMM_RX.fullmatch(txt)
+        m_ddmm = _DDMM_RX.fullmatch(txt)
+        m_rel = _DAY_WORD_RX.search(low)
 
         def _compute_basedate_from_text() -> str | None:
             if m_rel:
-                plus = {"сегодня": 0, "завтра": 1, "послезавтра": 2}[m_rel.group(1)]
+                plus = _DAY_WORD_SHIFT[m_rel.group(1)]
                 return (now_local + timedelta(days=plus)).date().isoformat()
             if m_ddmm:
                 dd = int(m_ddmm.group(1)); mm = int(m_ddmm.group(2))
@@ -1137,12 +1591,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
 
-    # ------- дальше внутри async def handle_text(...):
+    # ------- дальше внутри async def process_text(...):
 
     r = None
-    if OPENAI_API_KEY:
+    # во время уточнения ответ может быть любым («да», «Маше») — фильтр не применяем
+    if OPENAI_API_KEY and (is_clarify_active or _LLM_HINT_RX.search(low)):
         try:
-            r = await call_llm(incoming_text, user_tz)
+            r = await call_llm(incoming_text, user_tz, ctx_injection=ctx_injection)
             log.debug("llm_parse -> %r", r)
 
             # --- постфикс на случай, когда LLM ошибочно просит "дату"
@@ -1152,12 +1607,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                              lower() in ("date", "day")) or \
                             ("на какую дату" in (r.get("question") or "").lower())
 
-                s_low = incoming_text.lower()
-                md = re.search(r"\b(сегодня|завтра|послезавтра)\b", s_low)
-                mt = re.search(r"\b\d{1,2}(:\d{2})?\b", s_low)
-
-                if asks_date and md and not mt:
-                    base = {"сегодня": 0, "завтра": 1, "послезавтра": 2}[md.group(1)]
+                # regex — только когда модель действительно спросила дату
+                md = _DAY_WORD_RX.search(low) if asks_date else None
+                if md and not _BARE_TIME_RX.search(low):
+                    base = _DAY_WORD_SHIFT[md.group(1)]
                     base_day = (now_local + timedelta(days=base)).date().isoformat()
                     r = {
                         "intent": "ask_clarification",
@@ -1190,10 +1643,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         n = int(rec_obj.get("n") or 1)
         start_local = (rec_obj.get("start_at") or now_local.replace(microsecond=0).isoformat())
         recurrence = {"type": "interval", "unit": unit, "n": n, "start_at": start_local}
-        rem_id = db_add_reminder_recurring(user_id, title, None, recurrence, user_tz)
+        rem_id = await asyncio.to_thread(db_add_reminder_recurring, user_id, title, None, recurrence, user_tz)
         schedule_recurring(rem_id, user_id, title, recurrence, user_tz)
         phrase = _format_interval_phrase(unit, n)
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
+        kb = cancel_kb(rem_id)
         await safe_reply(update, f"⏰ Окей, буду напоминать «{title}» {phrase}", reply_markup=kb)
         set_clarify_state(context, None)
         return
@@ -1203,7 +1656,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     fixed = r.get("fixed_datetime")
     if fixed:
         try:
-            when_local = dparser.isoparse(fixed)
+            when_local = parse_iso(fixed)
         except Exception:
             when_local = None
 
@@ -1211,7 +1664,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         wl = r.get("when_local")  # на всякий случай, если модель вернёт старый ключ
         if wl is not None:
             try:
-                when_local = dparser.isoparse(str(wl))
+                when_local = parse_iso(str(wl))
             except Exception:
                 when_local = None
 
@@ -1231,17 +1684,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # [36] если модель подставила 00:00, но пользователь время не называл — спросим время
     def _text_has_time(s: str) -> bool:
-        s = s.lower()
-        # «в 9», «в 09», «в 9:30», «09:30» и пр.
-        return bool(
-            re.search(r"\bв\s+\d{1,2}(:\d{2})?\b", s) or
-            re.search(r"\b\d{1,2}:\d{2}\b", s)
-        )
+        return _HAS_TIME_RX.search(s) is not None
 
     if rec_obj:
         _rtype = (rec_obj.get("type") or "").lower()
         _rtime = (rec_obj.get("time") or "").strip()
-        if _rtype in {"daily", "weekly", "monthly", "yearly"} and (_rtime in {"0:00","00:00","00:00:00"}) and not _text_has_time(incoming_text):
+        if _rtype in {"daily", "weekly", "monthly", "yearly"} and (_rtime in {"0:00","00:00","00:00:00"}) and not _text_has_time(low):
             set_clarify_state(context, {
                 "title": title,
                 "base_date": None,
@@ -1264,11 +1712,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             recurrence["month"] = int(rec_obj.get("month") or 1)
             recurrence["day"] = int(rec_obj.get("day") or 1)
 
-        rem_id = db_add_reminder_recurring(user_id, title, None, recurrence, user_tz)
+        rem_id = await asyncio.to_thread(db_add_reminder_recurring, user_id, title, None, recurrence, user_tz)
         schedule_recurring(rem_id, user_id, title, recurrence, user_tz)
 
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Отменить", callback_data=f"del:{rem_id}")]])
-        human = format_reminder_line({"title": title, "kind":"recurring", "recurrence_json": json.dumps({**recurrence,"tz":user_tz})}, user_tz)
+        kb = cancel_kb(rem_id)
+        human = format_recurrence_line(recurrence, title)
         await safe_reply(update, f"⏰ Окей, {human}", reply_markup=kb)
         set_clarify_state(context, None)
         return
@@ -1291,7 +1739,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # [2] нормализация времени HH:MM:SS -> HH:MM + уникализация с сохранением порядка
         def _norm_time(s: str) -> str:
-            m = re.fullmatch(r"(\d{1,2}):(\d{2})(?::\d{2})?", (s or "").strip())
+            m = _HHMMSS_RX.fullmatch((s or "").strip())
             if m:
                 return f"{int(m.group(1)):02d}:{m.group(2)}"
             return (s or "").strip()
@@ -1299,22 +1747,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         variants = list(dict.fromkeys(_norm_time(v) for v in variants))
 
         if expects == "weekday":
-            labels = ["пн","вт","ср","чт","пт","сб","вс"]
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton(x, callback_data=f"answer:{x}")] for x in labels])
-            await safe_reply(update, question, reply_markup=kb)
+            await safe_reply(update, question, reply_markup=WEEKDAY_ANSWER_KB)
             return
 
-        if expects == "time" and len(variants) == 2 and all(re.fullmatch(r"\d{2}:\d{2}", v) for v in variants):
-            def _label(t: str) -> str:
-                hh = int(t[:2]); 
-                if hh == 0: return "в 00:00"
-                if 1 <= hh <= 11: return f"в {hh} утра"
-                return f"в {hh} часов"
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton(_label(variants[0]), callback_data=f"answer:{variants[0]}"),
-                 InlineKeyboardButton(_label(variants[1]), callback_data=f"answer:{variants[1]}")]
-            ])
-            await safe_reply(update, question, reply_markup=kb)
+        if expects == "time" and len(variants) == 2 and all(_HH_MM_RX.fullmatch(v) for v in variants):
+            await safe_reply(update, question, reply_markup=time_variants_kb(variants[0], variants[1]))
             return
 
         if variants:
@@ -1355,6 +1792,10 @@ async def on_startup(app: Application):
     global scheduler, TG_BOT
     TG_BOT = app.bot
     loop = asyncio.get_running_loop()
+    # пул для to_thread (sqlite, локальный ASR): апдейты идут по одному, OpenAI — async без потоков,
+    # так что хватает пары потоков. Явный маленький пул вместо дефолтного min(32, cpu+4) —
+    # у каждого потока своё sqlite-соединение, лишние потоки только множат их
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io"))
 
     jobstores = None
     if DB_DIALECT == "postgres" and DATABASE_URL:
@@ -1369,9 +1810,22 @@ async def on_startup(app: Application):
         jobstores=jobstores,
         job_defaults={"coalesce": True, "misfire_grace_time": 600}
     )
+    # восстановление — до start(): add_job у остановленного планировщика лишь копит джобы в очереди,
+    # start() кладёт их в jobstore пачкой и будит loop один раз, а не N раз (с проходом по jobstore на каждый).
+    # Выборка из БД синхронна — в потоке, loop на старте не ждёт
+    await asyncio.to_thread(reschedule_all)
     scheduler.start()
     log.info("APScheduler started in PTB event loop")
-    reschedule_all()
+
+async def on_shutdown(app: Application):
+    global _client
+    # keep-alive пул OpenAI закрываем явно: иначе сокеты висят до GC и httpx ругается на незакрытый клиент
+    if _client is not None:
+        try:
+            await _client.close()
+        except Exception:
+            log.exception("OpenAI client close failed")
+        _client = None
 
 # ---------- DB INIT ----------
 def db_init():
@@ -1400,11 +1854,16 @@ def db_init():
             # безопасные миграции
             conn.execute("alter table reminders add column if not exists parent_id bigint")
             conn.execute("alter table reminders add column if not exists offset_minutes integer")
-            conn.execute("create index if not exists reminders_user_idx on reminders(user_id)")
             conn.execute("create index if not exists reminders_status_idx on reminders(status)")
             conn.execute("create index if not exists reminders_parent_idx on reminders(parent_id)")
+            # /list: «свои + scheduled, новые сверху» — одним проходом по индексу, без сортировки.
+            # Он же покрывает выборки по одному user_id — старый reminders_user_idx лишь дорожил запись
+            conn.execute("create index if not exists reminders_user_status_idx on reminders(user_id, status, id)")
+            conn.execute("drop index if exists reminders_user_idx")
         else:
             import sqlite3
+            # WAL хранится в файле БД: читатели не блокируют запись, commit дешевле
+            conn.execute("pragma journal_mode=wal")
             conn.execute("""
                 create table if not exists users (
                     user_id integer primary key,
@@ -1452,6 +1911,13 @@ def db_init():
             except Exception:
                 pass
 
+            try:
+                conn.execute("create index if not exists reminders_status_idx on reminders(status)")
+                conn.execute("create index if not exists reminders_user_status_idx on reminders(user_id, status, id)")
+                conn.execute("drop index if exists reminders_user_idx")  # префикс составного — лишний
+            except Exception:
+                pass
+
             conn.commit()
 
 # ---------- PRE-ALERTS (старый обработчик для совместимости) ----------
@@ -1466,13 +1932,13 @@ async def cb_prealerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.edit_message_text("Окей, без предупреждений.")
             return
 
-        m = re.fullmatch(r"pre:(\d+):(\d+)", data)
+        m = _PRE_RX.fullmatch(data)
         if not m:
             return
         offset = int(m.group(1))
         parent_id = int(m.group(2))
 
-        parent = db_get_reminder(parent_id)
+        parent = await asyncio.to_thread(db_get_reminder, parent_id)
         if not parent:
             return await q.edit_message_text("Событие не найдено.")
 
@@ -1480,29 +1946,16 @@ async def cb_prealerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not when_iso:
             return await q.edit_message_text("Нельзя добавить предупреждение к этому событию.")
 
-        child_when_utc = dparser.isoparse(when_iso).astimezone(timezone.utc) - timedelta(minutes=offset)
-        if child_when_utc <= datetime.now(timezone.utc):
+        child_when_utc = parse_iso(when_iso).astimezone(timezone.utc) - timedelta(minutes=offset)
+        if child_when_utc <= _now_utc():
             await q.answer("Эта опция уже недоступна", show_alert=False)
             return
 
-        with db() as conn:
-            if DB_DIALECT == "postgres":
-                r = conn.execute(
-                    "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
-                    "values(%s,%s,%s,%s,'scheduled','oneoff',%s,%s) returning id",
-                    (parent["user_id"], parent["title"], parent.get("body"), iso_utc(child_when_utc), parent_id, offset)
-                ).fetchone()
-                child_id = r["id"]
-            else:
-                cur = conn.execute(
-                    "insert into reminders(user_id, title, body, when_iso, status, kind, parent_id, offset_minutes) "
-                    "values(?,?,?,?, 'scheduled','oneoff',?,?)",
-                    (parent["user_id"], parent["title"], parent.get("body"), iso_utc(child_when_utc), parent_id, offset)
-                )
-                conn.commit()
-                child_id = cur.lastrowid
-
-        schedule_oneoff(child_id, parent["user_id"], iso_utc(child_when_utc), parent["title"], kind="oneoff")
+        child_iso = iso_utc(child_when_utc)
+        (child_id,) = await asyncio.to_thread(
+            db_add_children, parent["user_id"], parent["title"], parent["body"], parent_id, [(child_iso, offset)]
+        )
+        schedule_oneoff(child_id, parent["user_id"], child_when_utc, parent["title"], kind="oneoff")
         await q.answer("Добавлено ✅", show_alert=False)
     except Exception:
         log.exception("cb_prealerts failed")
@@ -1514,12 +1967,28 @@ async def cb_prealerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------- MAIN ----------
 def main():
     log.info("Starting PlannerBot...")
+    try:
+        import uvloop  # опционально: libuv-цикл вместо asyncio по умолчанию
+        uvloop.install()
+        log.info("uvloop event loop enabled")
+    except ImportError:
+        pass
     db_init()
 
-    app = (Application.builder()
-           .token(BOT_TOKEN)
-           .post_init(on_startup)
-           .build())
+    builder = (Application.builder()
+               .token(BOT_TOKEN)
+               .persistence(PicklePersistence(filepath=STATE_PATH))
+               .http_version("2" if HTTP2 else "1.1")
+               .get_updates_read_timeout(40)
+               .get_updates_connect_timeout(10)
+               .post_init(on_startup)
+               .post_shutdown(on_shutdown))
+    try:
+        # 30 msg/s на бота + ретрай по RetryAfter вместо 429 в логах
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=3))
+    except RuntimeError:
+        log.warning("aiolimiter не установлен — исходящие сообщения без rate limit")
+    app = builder.build()
 
     app.add_error_handler(on_error)
 
@@ -1528,7 +1997,7 @@ def main():
     app.add_handler(CommandHandler("settings", lambda u,c: u.message.reply_text(
         "Раздел «Настройки» в разработке.", reply_markup=MAIN_MENU_KB)))
     app.add_handler(CallbackQueryHandler(cb_tz, pattern=r"^tz:"))
-    app.add_handler(CallbackQueryHandler(cb_inline, pattern=r"^(del:|done:|snooze:)"))
+    app.add_handler(CallbackQueryHandler(cb_inline, pattern=r"^(del|done|snooze):"))
     app.add_handler(CallbackQueryHandler(cb_pick, pattern=r"^pick:"))
     app.add_handler(CallbackQueryHandler(cb_answer, pattern=r"^answer:"))
     app.add_handler(CallbackQueryHandler(cb_prealerts, pattern=r"^pre:"))     # старый обработчик оставлен
@@ -1537,7 +2006,16 @@ def main():
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
 
-    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Telegram сам присылает апдейты; TLS терминирует прокси платформы
+        log.info("Starting webhook on port %s", PORT)
+        app.run_webhook(
+            listen="0.0.0.0", port=PORT, url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            drop_pending_updates=True, allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(timeout=25, drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()